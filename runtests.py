@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+运行stark组件的测试：python runtests.py
+组件在项目中以stark为包名使用，测试时通过软链接把tetrahedron目录映射为stark
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+import django
+from django.conf import settings
+from django.test.utils import get_runner
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    link_dir = tempfile.mkdtemp()
+    os.symlink(os.path.join(base_dir, 'tetrahedron'), os.path.join(link_dir, 'stark'))
+    sys.path[:0] = [link_dir, base_dir]
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+    try:
+        django.setup()
+        test_runner = get_runner(settings)()
+        failures = test_runner.run_tests(sys.argv[1:] or ['stark'])
+    finally:
+        shutil.rmtree(link_dir)
+    sys.exit(bool(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+from django.db import models
+
+
+class Depart(models.Model):
+    title = models.CharField(verbose_name='部门', max_length=32)
+
+    def __str__(self):
+        return self.title
+
+
+class UserInfo(models.Model):
+    name = models.CharField(verbose_name='姓名', max_length=32)
+    age = models.IntegerField(verbose_name='年龄', default=0)
+    gender = models.IntegerField(verbose_name='性别', choices=((1, '男'), (2, '女')), default=1)
+    depart = models.ForeignKey(verbose_name='部门', to='Depart', on_delete=models.CASCADE)
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,30 @@
+from django.db.models import F
+from stark.service.v1 import site, StarkHandler, Option, background_action
+from tests import models
+
+
+class UserInfoHandler(StarkHandler):
+    list_display = ['name', 'age']
+    list_summary = [('age', 'sum')]
+    search_group = [Option('depart', limit=2, search_field='title__contains'), Option('gender', limit=1)]
+
+    @background_action
+    def action_multi_grow(self, job, pk_list, *args, **kwargs):
+        for pk in pk_list:
+            models.UserInfo.objects.filter(pk=pk).update(age=F('age') + 1)
+            job.step()
+
+    action_multi_grow.text = '批量加一岁'
+
+    action_list = [StarkHandler.action_multi_delete, action_multi_grow]
+
+    def get_queryset(self, request, *args, **kwargs):
+        # 模拟按用户缩小数据范围：匿名用户看不到名称以private开头的数据
+        queryset = self.model_class.objects
+        if not request.user.is_authenticated:
+            queryset = queryset.exclude(name__startswith='private')
+        return queryset
+
+
+site.register(models.UserInfo, UserInfoHandler)
+site.register(models.UserInfo, UserInfoHandler, prev='x')
@@ -0,0 +1,6 @@
+from django.conf.urls import url
+from stark.service.v1 import site
+
+urlpatterns = [
+    url(r'^stark/', site.urls),
+]
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import io
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter, OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse, NoReverseMatch
+
+
+class StackSampler(threading.Thread):
+    """
+    定时采样指定线程的调用栈，生成火焰图所需的collapsed stacks（每行：frame1;frame2;... 次数）
+    cProfile只记录调用关系，无法还原完整的调用栈，因此另起线程采样
+    """
+
+    def __init__(self, thread_id, stop_code, interval=0.001):
+        """
+        :param thread_id: 被采样的线程ID
+        :param stop_code: 采样到该函数时停止向上回溯，去掉manage.py等无关的栈帧
+        :param interval: 采样间隔（秒）
+        """
+        super(StackSampler, self).__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stop_code = stop_code
+        self.interval = interval
+        self.counter = Counter()
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame and frame.f_code is not self.stop_code:
+                code = frame.f_code
+                stack.append('%s (%s:%s)' % (code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if frame and stack:  # 没有回溯到stop_code说明当前不在执行页面请求，丢弃
+                self.counter[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+class Command(BaseCommand):
+    help = '重放stark页面请求并进行性能分析，输出火焰图数据（collapsed stacks）、耗时最多的函数和SQL语句。' \
+           '例如：manage.py stark_profile app01/userinfo "q=kris&depart=1" -n 10'
+
+    view_dict = OrderedDict([
+        ('list', ('changelist_view', 'get_list_url_name')),
+        ('add', ('add_view', 'get_add_url_name')),
+        ('change', ('change_view', 'get_change_url_name')),
+        ('delete', ('delete_view', 'get_delete_url_name')),
+    ])
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', help='<app>/<model> 或 <app>/<model>/<prev>')
+        parser.add_argument('querystring', nargs='?', default='', help='请求的URL参数，例如："page=2&q=kris"')
+        parser.add_argument('--view', choices=list(self.view_dict), default='list', help='要分析的页面，默认list')
+        parser.add_argument('--pk', help='change/delete页面的数据ID')
+        parser.add_argument('-n', '--repeat', type=int, default=5, help='执行次数')
+        parser.add_argument('--user', help='以该用户名登录后发起请求，默认为匿名用户')
+        parser.add_argument('--top', type=int, default=20, help='显示耗时最多的前N个函数和SQL')
+        parser.add_argument('--sort', default='cumulative', help='函数排序方式，同pstats.sort_stats')
+        parser.add_argument('--warm', action='store_true',
+                            help='使用汇总/组合搜索排序的缓存，默认不读写缓存，以分析缓存未命中时的查询')
+        parser.add_argument('--collapsed', default='stark_profile.collapsed',
+                            help='collapsed stacks输出文件，可用flamegraph.pl/speedscope生成火焰图')
+
+    def get_handler(self, target):
+        from stark.service.v1 import site
+
+        part_list = target.strip('/').split('/')
+        if len(part_list) not in (2, 3):
+            raise CommandError('target格式错误，应为 <app>/<model> 或 <app>/<model>/<prev>')
+        handler = site.get_handler(*part_list)
+        if not handler:
+            raise CommandError('%s 没有注册到stark中' % target)
+        return handler
+
+    def build_request(self, handler, options):
+        view_name, url_name_attr = self.view_dict[options['view']]
+        kwargs = {}
+        if options['view'] in ('change', 'delete'):
+            if not options['pk']:
+                raise CommandError('%s页面需要指定--pk' % options['view'])
+            kwargs['pk'] = options['pk']
+        try:
+            path = reverse("%s:%s" % (handler.site.namespace, getattr(handler, url_name_attr),), kwargs=kwargs)
+        except NoReverseMatch as e:
+            raise CommandError('无法生成URL：%s' % e)
+
+        querystring = options['querystring'].lstrip('?')
+        request = RequestFactory().get('%s?%s' % (path, querystring) if querystring else path)
+        request.session = {}
+        if options['user']:
+            from django.contrib.auth import get_user_model
+            user_model = get_user_model()
+            try:
+                request.user = user_model.objects.get(**{user_model.USERNAME_FIELD: options['user']})
+            except user_model.DoesNotExist:
+                raise CommandError('用户 %s 不存在' % options['user'])
+        else:
+            from django.contrib.auth.models import AnonymousUser
+            request.user = AnonymousUser()
+        return handler.wrapper(getattr(handler, view_name)), request, kwargs
+
+    def run_view(self, view, request, kwargs):
+        return view(request, **kwargs)
+
+    def handle(self, *args, **options):
+        from stark.service import v1
+
+        origin_get_stark_cache = v1.get_stark_cache
+        if not options['warm']:
+            # 冷模式只在本进程中绕过缓存，不修改共享缓存的版本号，在线上执行时不会让其他用户的缓存失效
+            v1.get_stark_cache = lambda: None
+        try:
+            self.profile(options)
+        finally:
+            v1.get_stark_cache = origin_get_stark_cache
+
+    def profile(self, options):
+        handler = self.get_handler(options['target'])
+        view, request, kwargs = self.build_request(handler, options)
+        repeat = max(options['repeat'], 1)
+
+        profile = cProfile.Profile()
+        sampler = StackSampler(threading.get_ident(), self.run_view.__code__)
+        cost_list = []
+        captured_queries = []
+        sampler.start()
+        try:
+            for i in range(repeat):
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.time()
+                    profile.enable()
+                    response = self.run_view(view, request, kwargs)
+                    profile.disable()
+                    cost_list.append(time.time() - start)
+                captured_queries.extend(queries.captured_queries)
+        finally:
+            sampler.stop()
+
+        # ########## 1. 请求耗时 ##########
+        self.stdout.write('%s %s 状态码：%s' % (request.method, request.get_full_path(), response.status_code))
+        self.stdout.write('缓存：%s' % ('热（使用汇总/组合搜索排序缓存）' if options['warm'] else '冷（不读写汇总/组合搜索排序缓存）'))
+        self.stdout.write('执行%s次，平均%.3fs，最快%.3fs，最慢%.3fs' % (
+            repeat, sum(cost_list) / repeat, min(cost_list), max(cost_list)))
+
+        # ########## 2. 火焰图数据 ##########
+        with open(options['collapsed'], 'w', encoding='utf-8') as f:
+            for stack, count in sampler.counter.most_common():
+                f.write('%s %s\n' % (stack, count))
+        self.stdout.write('collapsed stacks已写入：%s（%s个采样）' % (
+            options['collapsed'], sum(sampler.counter.values())))
+
+        # ########## 3. 耗时最多的函数 ##########
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats(options['sort']).print_stats(options['top'])
+        self.stdout.write(stream.getvalue())
+
+        # ########## 4. SQL语句 ##########
+        sql_dict = OrderedDict()  # {sql: [执行次数, 总耗时, 最大耗时]}
+        for query in captured_queries:
+            cost = float(query['time'])
+            item = sql_dict.setdefault(query['sql'], [0, 0.0, 0.0])
+            item[0] += 1
+            item[1] += cost
+            item[2] = max(item[2], cost)
+        total_cost = sum(item[1] for item in sql_dict.values())
+        self.stdout.write('SQL：每次请求%.1f条，总耗时%.3fs' % (len(captured_queries) / repeat, total_cost))
+        sql_list = sorted(sql_dict.items(), key=lambda item: item[1][1], reverse=True)
+        for sql, (count, cost, max_cost) in sql_list[:options['top']]:
+            self.stdout.write('%8.3fs %5s次 最大%.3fs  %s' % (cost, count, max_cost, sql))
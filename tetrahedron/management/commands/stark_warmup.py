@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = '预热所有stark handler（ModelForm、URL、模板、组合搜索排序），并输出每个handler的耗时。' \
+           '汇总结果按用户缓存，只有指定--user时才预热该用户的汇总结果。' \
+           '本命令预热的是数据库和共享缓存，web进程内部的预热需在wsgi.py中调用site.warmup_in_background()'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='并发预热的线程数')
+        parser.add_argument('--user', help='预热该用户名的汇总结果')
+
+    def handle(self, *args, **options):
+        from stark.service.v1 import site
+
+        user = None
+        if options['user']:
+            from django.contrib.auth import get_user_model
+            user_model = get_user_model()
+            try:
+                user = user_model.objects.get(**{user_model.USERNAME_FIELD: options['user']})
+            except user_model.DoesNotExist:
+                raise CommandError('用户 %s 不存在' % options['user'])
+
+        start = time.time()
+        result = site.warmup(max_workers=options['workers'], user=user)
+        for handler, cost, error in result:
+            if error:
+                self.stderr.write('%-40s 失败：%r' % (handler.get_list_url_name, error))
+            else:
+                self.stdout.write('%-40s %.3fs' % (handler.get_list_url_name, cost))
+        self.stdout.write('共预热%s个handler，总耗时%.3fs' % (len(result), time.time() - start))
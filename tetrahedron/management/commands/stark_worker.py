@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import datetime
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+
+
+def init_worker():
+    """
+    进程池子进程初始化，spawn方式启动的子进程需要重新加载django（会执行autodiscover，注册所有handler）
+    """
+    django.setup()
+
+
+def run_job(job_id):
+    """
+    在子进程中执行一个后台任务，必须是模块级函数才能被进程池pickle
+    """
+    from stark.models import StarkJob
+    from stark.service.v1 import site
+
+    job = StarkJob.objects.filter(pk=job_id).first()
+    if not job:
+        return
+
+    handler = site.get_handler(job.app_label, job.model_name, job.prev)
+    action_func = getattr(handler, job.action, None) if handler else None
+    # 与changelist_view一致，只允许执行action_list中的后台action，防止恶意
+    allowed = handler and job.action in {func.__name__ for func in handler.get_action_list()}
+    if not allowed or not getattr(action_func, 'is_background', False):
+        job.status = 4
+        job.errors += '找不到后台操作：%s\n' % job.action
+    else:
+        params = json.loads(job.params)
+        try:
+            action_func(job, params.get('pk_list', []), *params.get('args', []), **params.get('kwargs', {}))
+        except Exception:
+            job.errors += traceback.format_exc()
+            job.status = 4
+        else:
+            job.status = 3
+        handler.clear_summary_cache()
+    # 以status=2为条件更新，执行期间任务可能已被fail_stale_jobs标记为失败，不能覆盖
+    StarkJob.objects.filter(pk=job.pk, status=2).update(
+        status=job.status, errors=job.errors, finish_time=timezone.now())
+
+
+class Command(BaseCommand):
+    help = '执行stark后台任务（被background_action装饰的批量操作）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None, help='进程池大小，默认为CPU核数')
+        parser.add_argument('--interval', type=float, default=2, help='没有任务时轮询任务表的间隔（秒）')
+        parser.add_argument('--once', action='store_true', help='执行完当前排队的任务后退出')
+        parser.add_argument('--stale', type=float, default=60,
+                            help='执行中的任务超过该时间（秒）没有心跳则认为worker已退出，将任务标记为失败')
+
+    def claim_jobs(self, limit):
+        """
+        领取排队中的任务，以status=1为条件更新，多个worker同时运行时同一任务只会被一个worker领取
+        """
+        from stark.models import StarkJob
+
+        job_id_list = StarkJob.objects.filter(status=1).order_by('id').values_list('id', flat=True)[:limit]
+        claimed = []
+        for job_id in list(job_id_list):
+            now = timezone.now()
+            if StarkJob.objects.filter(pk=job_id, status=1).update(status=2, start_time=now, heartbeat_time=now):
+                claimed.append(job_id)
+        return claimed
+
+    def heartbeat(self, job_id_list):
+        """
+        更新执行中任务的心跳时间
+        """
+        from stark.models import StarkJob
+
+        if job_id_list:
+            StarkJob.objects.filter(pk__in=job_id_list, status=2).update(heartbeat_time=timezone.now())
+
+    def fail_stale_jobs(self, stale):
+        """
+        执行中但长时间没有心跳的任务（worker被kill、部署重启、OOM等）标记为失败。
+        任务可能已经执行了一部分，重新执行不一定安全，因此不自动重新排队
+        """
+        from stark.models import StarkJob
+
+        now = timezone.now()
+        deadline = now - datetime.timedelta(seconds=stale)
+        stale_job_list = StarkJob.objects.filter(
+            Q(heartbeat_time__lt=deadline) | Q(heartbeat_time__isnull=True, start_time__lt=deadline), status=2)
+        for job in stale_job_list:
+            # 以status=2和心跳时间为条件更新，避免与正在执行的worker冲突
+            count = StarkJob.objects.filter(pk=job.pk, status=2, heartbeat_time=job.heartbeat_time).update(
+                status=4, errors='%s执行该任务的worker已退出\n' % job.errors, finish_time=now)
+            if count:
+                self.stderr.write('任务%s没有心跳，已标记为失败' % job.pk)
+
+    def mark_failed(self, job_id, exc):
+        from stark.models import StarkJob
+
+        job = StarkJob.objects.filter(pk=job_id).first()
+        if not job or job.is_finished:
+            return
+        StarkJob.objects.filter(pk=job_id, status=2).update(
+            status=4, errors='%s%r\n' % (job.errors, exc), finish_time=timezone.now())
+
+    def create_pool(self, max_workers):
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker)
+
+    def recreate_pool(self, pool, max_workers):
+        self.stderr.write('进程池已损坏，重新创建')
+        pool.shutdown(wait=False)
+        return self.create_pool(max_workers)
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        max_workers = options['processes'] or os.cpu_count() or 1
+        pool = self.create_pool(max_workers)
+        running = {}
+        self.stdout.write('stark_worker启动，进程数：%s' % max_workers)
+        try:
+            while True:
+                self.heartbeat(list(running.values()))
+                self.fail_stale_jobs(options['stale'])
+                broken = False
+                for future, job_id in list(running.items()):
+                    if not future.done():
+                        continue
+                    running.pop(future)
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        broken = True
+                    if future.exception():
+                        # 子进程崩溃时run_job来不及更新状态，由主进程标记为失败
+                        self.mark_failed(job_id, future.exception())
+                        self.stderr.write('任务%s异常退出：%s' % (job_id, future.exception()))
+                    else:
+                        self.stdout.write('任务%s执行结束' % job_id)
+
+                # 子进程被kill（段错误、OOM等）后进程池无法再使用，执行中的任务都会以BrokenProcessPool结束，需要重新创建
+                if broken:
+                    pool = self.recreate_pool(pool, max_workers)
+
+                claimed = self.claim_jobs(max_workers - len(running)) if len(running) < max_workers else []
+                if claimed:
+                    # 子进程可能通过fork创建，提交前关闭数据库连接，避免父子进程共用同一个连接
+                    connections.close_all()
+                    broken_error = None
+                    for job_id in claimed:
+                        if not broken_error:
+                            try:
+                                running[pool.submit(run_job, job_id)] = job_id
+                                self.stdout.write('任务%s开始执行' % job_id)
+                                continue
+                            except BrokenProcessPool as e:
+                                broken_error = e
+                        # 已领取的任务不能停留在执行中，标记为失败
+                        self.mark_failed(job_id, broken_error)
+                        self.stderr.write('任务%s提交失败：%r' % (job_id, broken_error))
+                    if broken_error:
+                        pool = self.recreate_pool(pool, max_workers)
+                elif options['once'] and not running:
+                    break
+                else:
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            self.stdout.write('stark_worker退出，等待执行中的任务结束...')
+        finally:
+            pool.shutdown(wait=True)
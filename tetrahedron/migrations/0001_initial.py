@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StarkJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('app_label', models.CharField(max_length=64, verbose_name='APP名称')),
+                ('model_name', models.CharField(max_length=64, verbose_name='表名称')),
+                ('prev', models.CharField(blank=True, max_length=64, null=True, verbose_name='URL前缀')),
+                ('action', models.CharField(max_length=64, verbose_name='操作')),
+                ('params', models.TextField(default='{}', verbose_name='参数')),
+                ('status', models.IntegerField(choices=[(1, '排队中'), (2, '执行中'), (3, '已完成'), (4, '失败')], default=1, verbose_name='状态')),
+                ('total', models.IntegerField(default=0, verbose_name='总数')),
+                ('processed', models.IntegerField(default=0, verbose_name='已处理')),
+                ('errors', models.TextField(blank=True, default='', verbose_name='错误信息')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('start_time', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('finish_time', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+            ],
+        ),
+    ]
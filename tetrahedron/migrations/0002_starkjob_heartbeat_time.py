@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stark', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='starkjob',
+            name='heartbeat_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='心跳时间'),
+        ),
+    ]
@@ -1,3 +1,49 @@
 from django.db import models
 
-# Create your models here.
+
+class StarkJob(models.Model):
+    """
+    后台任务表，被background_action装饰的批量操作不会在请求中执行，而是写入此表，由 manage.py stark_worker 执行
+    """
+    status_choices = (
+        (1, '排队中'),
+        (2, '执行中'),
+        (3, '已完成'),
+        (4, '失败'),
+    )
+    app_label = models.CharField(verbose_name='APP名称', max_length=64)
+    model_name = models.CharField(verbose_name='表名称', max_length=64)
+    prev = models.CharField(verbose_name='URL前缀', max_length=64, null=True, blank=True)
+    action = models.CharField(verbose_name='操作', max_length=64)
+    # json格式：{"pk_list": [...], "args": [...], "kwargs": {...}}
+    params = models.TextField(verbose_name='参数', default='{}')
+    status = models.IntegerField(verbose_name='状态', choices=status_choices, default=1)
+    total = models.IntegerField(verbose_name='总数', default=0)
+    processed = models.IntegerField(verbose_name='已处理', default=0)
+    errors = models.TextField(verbose_name='错误信息', blank=True, default='')
+    create_time = models.DateTimeField(verbose_name='创建时间', auto_now_add=True)
+    start_time = models.DateTimeField(verbose_name='开始时间', null=True, blank=True)
+    finish_time = models.DateTimeField(verbose_name='结束时间', null=True, blank=True)
+    # 执行中由stark_worker定时更新，长时间未更新说明worker进程已退出
+    heartbeat_time = models.DateTimeField(verbose_name='心跳时间', null=True, blank=True)
+
+    def __str__(self):
+        return '%s.%s %s' % (self.app_label, self.model_name, self.action)
+
+    @property
+    def is_finished(self):
+        return self.status in (3, 4)
+
+    def step(self, count=1):
+        """
+        在后台action中调用，汇报已处理的数据条数
+        """
+        self.processed += count
+        self.save(update_fields=['processed'])
+
+    def add_error(self, message):
+        """
+        在后台action中调用，记录某条数据处理失败的原因，任务会继续执行
+        """
+        self.errors += '%s\n' % message
+        self.save(update_fields=['errors'])
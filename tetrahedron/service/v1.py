@@ -1,16 +1,85 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
+import copy
+import json
+import time
+import logging
+import threading
+import hashlib
 import functools
+from urllib.parse import quote_plus
+from concurrent.futures import ThreadPoolExecutor
 from types import FunctionType  # 函数类型
 from django.conf.urls import url
-from django.urls import reverse
+from django.urls import reverse, get_resolver, NoReverseMatch
+from django.db import connection
+from django.template import Context
+from django.template.loader import get_template
+from django.template.loader_tags import ExtendsNode
 from django.utils.safestring import mark_safe
 from django.shortcuts import HttpResponse, render, redirect
-from django.http import QueryDict
+from django.http import QueryDict, JsonResponse, HttpRequest
 from django import forms
-from django.db.models import Q
+from django.db.models import Q, Count, Sum, Avg, Max, Min
+from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ValidationError
+from django.contrib.auth.models import AnonymousUser
 from stark.utils.pagination import Pagination
 from django.db.models import ForeignKey, ManyToManyField
+from stark.models import StarkJob
+
+logger = logging.getLogger('stark')
+
+
+# list_summary支持的聚合函数 {'配置名': (聚合类, 页面显示的文本)}
+SUMMARY_FUNCTIONS = {
+    'sum': (Sum, '合计'),
+    'avg': (Avg, '平均'),
+    'max': (Max, '最大'),
+    'min': (Min, '最小'),
+}
+
+
+def get_stark_cache():
+    """
+    获取汇总和组合搜索排序使用的缓存。
+    数据变更后需要让所有web进程和stark_worker中的缓存同时失效，因此必须是跨进程共享的缓存（redis、memcached、数据库等）
+    默认的LocMemCache只在当前进程有效，此时返回None，不使用缓存
+    """
+    backend = caches[DEFAULT_CACHE_ALIAS]
+    if isinstance(backend, LocMemCache):
+        return None
+    return backend
+
+
+def get_cache_version_key(model_class):
+    return 'stark:%s:version' % model_class._meta.label_lower
+
+
+def get_cache_version(model_class):
+    """
+    获取表的缓存版本号，缓存key中带上版本号，数据变更后修改版本号即可让该表的缓存全部失效
+    """
+    cache = get_stark_cache()
+    if not cache:
+        return 0
+    return cache.get(get_cache_version_key(model_class)) or 0
+
+
+def clear_cache_version(model_class):
+    """
+    修改表的缓存版本号，使用incr保证并发修改时版本号不会重复
+    """
+    cache = get_stark_cache()
+    if not cache:
+        return
+    version_key = get_cache_version_key(model_class)
+    cache.add(version_key, 0, None)
+    try:
+        cache.incr(version_key)
+    except ValueError:  # add和incr之间key被淘汰
+        cache.set(version_key, int(time.time()), None)
 
 
 def get_choice_text(title, field):
@@ -68,71 +137,111 @@ def get_m2m_text(title, field):
     return inner
 
 
+def background_action(func):
+    """
+    将批量操作标记为后台任务。执行时不在请求中运行，而是写入StarkJob表，由 manage.py stark_worker 进程池执行，
+    页面跳转到任务进度页面。
+    被装饰的函数签名为 func(self, job, pk_list, *args, **kwargs)，执行中可调用job.step()汇报进度、job.add_error()记录错误
+    用法：
+        @background_action
+        def action_multi_init(self, job, pk_list, *args, **kwargs):
+            ...
+        action_multi_init.text = "批量初始化"
+    """
+    func.is_background = True
+    return func
+
+
 class SearchGroupRow(object):
-    def __init__(self, title, queryset_or_tuple, option, query_dict):
+    def __init__(self, title, queryset_or_tuple, option, query_dict, has_more=False):
         """
         让choice和foreignkey或manytomany有一个统一的样式，返回给前端直接用for循环进行渲染。即把前端用于判断的代码写到了后端
         :param title: 组合搜索的列名称
         :param queryset_or_tuple: 组合搜索关联获取到的数据
         :param option: 配置
         :param query_dict: request.GET
+        :param has_more: 配置了limit时，是否还有未显示的选项
         """
         self.title = title
         self.queryset_or_tuple = queryset_or_tuple
         self.option = option
         self.query_dict = query_dict
+        self.has_more = has_more
+        self.more_url = None  # "更多"选项的加载地址，由StarkHandler设置
 
     def __iter__(self):
         yield '<div class="whole">'
         yield self.title
         yield '</div>'
         yield '<div class="others">'
-        total_query_dict = self.query_dict.copy()  # QueryDict内置的copy()为深拷贝，拷贝一份为了让后续其他操作不会互相影响
-        total_query_dict._mutable = True
+        for html in self.iter_options(with_total=True):
+            yield html
+
+        if self.more_url:
+            yield "<span class='facet-more' data-url='%s' data-page='2'>" % self.more_url
+            yield "<a class='facet-more-btn' href='javascript:void(0);'>更多 <i class='fa fa-angle-down'></i></a>"
+            if self.option.search_field:
+                yield "<input class='facet-keyword form-control input-sm' style='display: none;' placeholder='搜索'>"
+            yield "</span>"
+        yield '</div>'
 
-        origin_value_list = self.query_dict.getlist(self.option.field)
-        if not origin_value_list:  # 如果没有字段被选中，则选中全部
-            yield "<a class='active' href='?%s'>全部</a>" % total_query_dict.urlencode()
-        else:  # 如果该字段被选中了
-            total_query_dict.pop(self.option.field)  # 获取点击全部按钮的url
-            yield "<a href='?%s'>全部</a>" % total_query_dict.urlencode()  # 当点击全部时，删除已选的字段参数
+    def iter_options(self, with_total=False):
+        """
+        生成每个选项的a标签。
+        其他字段的URL参数对所有选项都一样，每次请求只拷贝和编码一次，每个选项只需要拼接本字段的参数
+        :param with_total: 是否生成"全部"选项
+        """
+        field = self.option.field
+        origin_value_list = self.query_dict.getlist(field)
+
+        other_query_dict = self.query_dict.copy()  # QueryDict内置的copy()为深拷贝，拷贝一份为了让后续其他操作不会互相影响
+        other_query_dict._mutable = True
+        other_query_dict.pop(field, None)
+        other_param = other_query_dict.urlencode()
+        field_prefix = '%s=' % quote_plus(field)
+
+        def build_url(value_list):
+            param_list = [other_param] if other_param else []
+            param_list.extend(field_prefix + quote_plus(value) for value in value_list)
+            return '?%s' % '&'.join(param_list)
+
+        if with_total:
+            if not origin_value_list:  # 如果没有字段被选中，则选中全部
+                yield "<a class='active' href='%s'>全部</a>" % build_url([])
+            else:  # 当点击全部时，删除已选的字段参数
+                yield "<a href='%s'>全部</a>" % build_url([])
 
         for item in self.queryset_or_tuple:
             text = self.option.get_text(item)  # 获取文本
             value = str(self.option.get_value(item))  # 获取choice/对象对应的id
-            query_dict = self.query_dict.copy()
-            query_dict._mutable = True
 
             if not self.option.is_multi:  # 单选
-                query_dict[self.option.field] = value  # 给url设置新的参数
                 if value in origin_value_list:
-                    query_dict.pop(self.option.field)
-                    yield "<a class='active' href='?%s'>%s</a>" % (query_dict.urlencode(), text)
+                    yield "<a class='active' href='%s'>%s</a>" % (build_url([]), text)
                 else:
-                    yield "<a href='?%s'>%s</a>" % (query_dict.urlencode(), text)
+                    yield "<a href='%s'>%s</a>" % (build_url([value]), text)
             else:  # 多选
                 # {'gender':['1','2']}
-                multi_value_list = query_dict.getlist(self.option.field)
-                if value in multi_value_list:  # 如果url中已经有value
-                    multi_value_list.remove(value)  # 在url中删除指定value
-                    query_dict.setlist(self.option.field, multi_value_list)
-                    yield "<a class='active' href='?%s'>%s</a>" % (query_dict.urlencode(), text)
+                if value in origin_value_list:  # 如果url中已经有value，则在url中删除指定value
+                    multi_value_list = [origin for origin in origin_value_list if origin != value]
+                    yield "<a class='active' href='%s'>%s</a>" % (build_url(multi_value_list), text)
                 else:
-                    multi_value_list.append(value)
-                    query_dict.setlist(self.option.field, multi_value_list)
-                    yield "<a href='?%s'>%s</a>" % (query_dict.urlencode(), text)
-
-        yield '</div>'
+                    yield "<a href='%s'>%s</a>" % (build_url(origin_value_list + [value]), text)
 
 
 class Option(object):
-    def __init__(self, field, is_multi=False, db_condition=None, text_func=None, value_func=None):
+    def __init__(self, field, is_multi=False, db_condition=None, text_func=None, value_func=None, limit=None,
+                 order_by=None, search_field=None, cache_timeout=300):
         """
         :param field: 组合搜索关联的字段
         :param is_multi: 是否支持多选
         :param db_condition: 数据库关联查询时的条件
         :param text_func: 此函数用于显示组合搜索按钮页面文本
         :param value_func: 此函数用于显示组合搜索按钮值
+        :param limit: FK/M2M关联数据较多时只显示前N个，其余的点击"更多"后分页加载
+        :param order_by: 配置limit时前N个的排序，例如['title', ]，默认按关联的数据条数倒序
+        :param search_field: "更多"中的搜索条件，例如'title__contains'
+        :param cache_timeout: 按关联数据条数排序时，排序结果的缓存时间（秒），同样需要跨进程共享的缓存
         """
         self.field = field
         self.is_multi = is_multi
@@ -141,12 +250,57 @@ class Option(object):
         self.db_condition = db_condition
         self.text_func = text_func
         self.value_func = value_func
+        self.limit = limit
+        self.order_by = order_by
+        self.search_field = search_field
+        self.cache_timeout = cache_timeout
 
         self.is_choice = False
 
     def get_db_condition(self, request, *args, **kwargs):
         return self.db_condition  # 筛选条件
 
+    def get_related_queryset(self, field_object, request, *args, **kwargs):
+        """
+        获取FK/M2M关联表中的数据
+        """
+        db_condition = self.get_db_condition(request, *args, **kwargs)
+        # Django1.*  找到关联表的对象使用.rel
+        # Django2.*  找到关联表的对象使用.remote_field
+        return field_object.remote_field.model.objects.filter(**db_condition)
+
+    def get_ordered_pk_list(self, field_object, queryset):
+        """
+        按关联的数据条数倒序的pk列表，最常用的选项排在前面。
+        统计需要关联主表分组查询，结果只缓存pk，按查询条件缓存，主表数据变更后随版本号失效
+        """
+        cache = get_stark_cache()
+        if not cache:
+            return self.query_ordered_pk_list(field_object, queryset)
+        model_class = field_object.model
+        digest = hashlib.md5(str(queryset.query).encode('utf-8')).hexdigest()
+        cache_key = 'stark:%s:facet:%s:%s:%s' % (
+            model_class._meta.label_lower, self.field, get_cache_version(model_class), digest)
+        pk_list = cache.get(cache_key)
+        if pk_list is None:
+            pk_list = self.query_ordered_pk_list(field_object, queryset)
+            cache.set(cache_key, pk_list, self.cache_timeout)
+        return pk_list
+
+    def query_ordered_pk_list(self, field_object, queryset):
+        return list(queryset.annotate(stark_facet_count=Count(field_object.related_query_name())).order_by(
+            '-stark_facet_count', 'pk').values_list('pk', flat=True))
+
+    def get_option_list(self, field_object, queryset, start, end):
+        """
+        配置了limit时，按order_by或关联的数据条数获取第start到end个选项
+        """
+        if self.order_by or field_object.remote_field.is_hidden():  # related_name='+'时无法反向查询
+            return list(queryset.order_by(*(self.order_by or ['pk']))[start:end])
+        pk_list = self.get_ordered_pk_list(field_object, queryset)[start:end]
+        object_dict = queryset.in_bulk(pk_list)
+        return [object_dict[pk] for pk in pk_list if pk in object_dict]
+
     def get_queryset_or_tuple(self, model_class, request, *args, **kwargs):
         """
         根据字段去获取数据库关联的数据
@@ -157,12 +311,23 @@ class Option(object):
         # 获取关联数据
         if isinstance(field_object, ForeignKey) or isinstance(field_object, ManyToManyField):
             # FK和M2M,应该去获取其关联表中的数据： QuerySet
-            db_condition = self.get_db_condition(request, *args, **kwargs)
-            # Django1.*  找到关联表的对象使用.rel
-            # return SearchGroupRow(title, field_object.rel.model.objects.filter(**db_condition), self, request.GET)
-            # Django2.*  找到关联表的对象使用.remote_field
-            return SearchGroupRow(title, field_object.remote_field.model.objects.filter(**db_condition), self,
-                                  request.GET)
+            queryset = self.get_related_queryset(field_object, request, *args, **kwargs)
+            if not self.limit:
+                return SearchGroupRow(title, queryset, self, request.GET)
+
+            # 多取一条用于判断是否还有更多选项，避免count()
+            item_list = self.get_option_list(field_object, queryset, 0, self.limit + 1)
+            has_more = len(item_list) > self.limit
+            item_list = item_list[:self.limit]
+            # 已选中但不在前N个中的选项也要显示，否则页面上无法取消选中
+            exist_value_set = {str(self.get_value(item)) for item in item_list}
+            missing_value_list = [value for value in request.GET.getlist(self.field) if value not in exist_value_set]
+            if missing_value_list and not self.value_func:
+                try:
+                    item_list.extend(queryset.filter(pk__in=missing_value_list))
+                except (ValueError, ValidationError):  # URL中的值不合法时忽略
+                    pass
+            return SearchGroupRow(title, item_list, self, request.GET, has_more=has_more)
         else:
             # 获取choice中的数据：元组
             self.is_choice = True
@@ -226,11 +391,17 @@ class StarkHandler(object):
 
     search_group = []  # 组合搜索
 
+    list_summary = []  # 汇总行，例如：[('price', 'sum'), ('price', 'avg')]，支持sum/avg/max/min
+
+    # 汇总结果缓存时间（秒）。需要配置跨进程共享的缓存（redis、memcached等），默认的LocMemCache不缓存，见get_stark_cache
+    list_summary_cache_timeout = 60
+
     def __init__(self, site, model_class, prev):
         self.site = site  # StarkSite对象
         self.model_class = model_class
         self.prev = prev
         self.request = None  # 默认为None，目的是为了让该类所有的函数都可以使用request，而不用在调用不同的函数时，传递request参数
+        self._dynamic_model_form_class = None  # 缓存动态生成的ModelForm，避免每次请求都重新构造
 
     def display_checkbox(self, obj=None, is_header=None):
         """
@@ -283,11 +454,15 @@ class StarkHandler(object):
         if self.model_form_class:  # 支持自定制model_form_class
             return self.model_form_class
 
+        if self._dynamic_model_form_class:
+            return self._dynamic_model_form_class
+
         class DynamicModelForm(StarkModelForm):
             class Meta:
                 model = self.model_class
                 fields = "__all__"
 
+        self._dynamic_model_form_class = DynamicModelForm
         return DynamicModelForm
 
     def get_order_list(self):
@@ -311,6 +486,80 @@ class StarkHandler(object):
     def get_search_group(self):
         return self.search_group
 
+    def get_list_summary(self):
+        return self.list_summary
+
+    def get_summary_cache_key(self, request):
+        """
+        根据URL、当前用户和搜索条件（不含页码）生成汇总结果的缓存key，每个用户的每个筛选条件单独缓存
+        get_queryset可能根据用户返回不同的数据（例如配合权限组件），因此不同用户不能共用缓存
+        """
+        query_params = request.GET.copy()
+        query_params._mutable = True
+        query_params.pop('page', None)
+        user = getattr(request, 'user', None)
+        condition = [request.path_info, getattr(user, 'pk', None)]
+        condition.extend((key, sorted(query_params.getlist(key))) for key in sorted(query_params))
+        digest = hashlib.md5(json.dumps(condition).encode('utf-8')).hexdigest()
+        version = get_cache_version(self.model_class)
+        return 'stark:%s:summary:%s:%s' % (self.model_class._meta.label_lower, version, digest)
+
+    def clear_summary_cache(self):
+        """
+        数据变更后调用，让该表所有筛选条件的汇总缓存失效（同一个表通过不同prev注册的handler共用版本号）
+        """
+        clear_cache_version(self.model_class)
+
+    def get_summary(self, request, queryset):
+        """
+        一次aggregate查询同时获取总条数(stark_count)和所有汇总值，结果按筛选条件缓存
+        :return: {'stark_count': 100, 'price__sum': 1000, ...}
+        """
+        cache = get_stark_cache()
+        if not cache:
+            return self.query_summary(queryset)
+        cache_key = self.get_summary_cache_key(request)
+        summary = cache.get(cache_key)
+        if summary is None:
+            summary = self.query_summary(queryset)
+            cache.set(cache_key, summary, self.list_summary_cache_timeout)
+        return summary
+
+    def query_summary(self, queryset):
+        aggregate_dict = {'stark_count': Count('pk')}
+        for field, func_name in self.get_list_summary():
+            aggregate_dict['%s__%s' % (field, func_name)] = SUMMARY_FUNCTIONS[func_name][0](field)
+        return queryset.order_by().aggregate(**aggregate_dict)  # 聚合时不需要排序
+
+    def get_summary_row(self, list_display, summary):
+        """
+        生成表格的汇总行，汇总值显示在对应字段的列下，没有显示在表格中的字段放到第一列
+        """
+        cell_dict = {}
+        for field, func_name in self.get_list_summary():
+            value = summary['%s__%s' % (field, func_name)]
+            if value is None:
+                value = '-'
+            elif func_name == 'avg':
+                value = round(value, 2)
+            cell_dict.setdefault(field, []).append('%s：%s' % (SUMMARY_FUNCTIONS[func_name][1], value))
+
+        column_list = list_display or [None]
+        summary_list = []
+        for key_or_func in column_list:
+            if isinstance(key_or_func, str):
+                summary_list.append(' '.join(cell_dict.pop(key_or_func, [])))
+            else:
+                summary_list.append('')
+
+        text_list = ['汇总'] if not summary_list[0] else []
+        for field, cell in cell_dict.items():
+            verbose_name = self.model_class._meta.get_field(field).verbose_name
+            text_list.append('%s %s' % (verbose_name, ' '.join(cell)))
+        text_list.append(summary_list[0])
+        summary_list[0] = ' '.join(filter(None, text_list))
+        return summary_list
+
     def get_search_group_condition(self, request):
         """
         获取组合搜索的条件
@@ -349,7 +598,12 @@ class StarkHandler(object):
         if request.method == 'POST':
             action_func_name = request.POST.get('action')
             if action_func_name and action_func_name in action_dict:  # 确认是否在action_dict里，防止恶意
-                action_response = getattr(self, action_func_name)(request, *args, **kwargs)
+                action_func = getattr(self, action_func_name)
+                if getattr(action_func, 'is_background', False):  # 后台任务：只入队，跳转到任务进度页面
+                    job = self.create_job(request, action_func_name, *args, **kwargs)
+                    return redirect(self.reverse_job_url(pk=job.pk))
+                action_response = action_func(request, *args, **kwargs)
+                self.clear_summary_cache()
                 if action_response:  # 如果执行的函数有返回值，例如执行后确认或执行后跳转到其他页面
                     return action_response  # 执行函数返回值
 
@@ -374,7 +628,12 @@ class StarkHandler(object):
             *order_list)
 
         # ########## 4. 处理分页 ##########
-        all_count = queryset.count()  # 获取总数据
+        list_summary = self.get_list_summary()
+        if list_summary:  # 有汇总配置时，总条数和汇总值在同一个aggregate查询中获取
+            summary = self.get_summary(request, queryset)
+            all_count = summary['stark_count']
+        else:
+            all_count = queryset.count()  # 获取总数据
 
         query_params = request.GET.copy()
         query_params._mutable = True
@@ -417,6 +676,9 @@ class StarkHandler(object):
                 tr_list.append(row)
             body_list.append(tr_list)
 
+        # 5.3 处理汇总行
+        summary_list = self.get_summary_row(list_display, summary) if list_summary else []
+
         # ########## 6. 添加按钮 #########
         add_btn = self.get_add_btn(request, *args, **kwargs)
 
@@ -425,6 +687,8 @@ class StarkHandler(object):
         search_group = self.get_search_group()  # ['gender', 'depart']
         for option_object in search_group:
             row = option_object.get_queryset_or_tuple(self.model_class, request, *args, **kwargs)
+            if row.has_more:  # 其余选项点击"更多"后加载
+                row.more_url = self.reverse_facet_url(field=option_object.field)
             search_group_row_list.append(row)
 
         return render(
@@ -434,6 +698,7 @@ class StarkHandler(object):
                 'data_list': data_list,
                 'header_list': header_list,
                 'body_list': body_list,
+                'summary_list': summary_list,
                 'pager': pager,
                 'add_btn': add_btn,
                 'search_list': search_list,
@@ -462,6 +727,7 @@ class StarkHandler(object):
         form = model_form_class(data=request.POST)
         if form.is_valid():
             self.save(request, form, is_update=False)  # 自定义数据保存前的一些操作
+            self.clear_summary_cache()
             # 在数据库保存成功后，跳转回列表页面(携带原来的参数)
             return redirect(self.reverse_list_url(*args, **kwargs))
         return render(request, 'stark/change.html', {'form': form})
@@ -481,6 +747,7 @@ class StarkHandler(object):
         form = model_form_class(data=request.POST, instance=current_change_object)
         if form.is_valid():
             self.save(request, form, is_update=True)
+            self.clear_summary_cache()
             return redirect(self.reverse_list_url(*args, **kwargs))  # 非弹窗验证时使用方法
 
         return render(request, 'stark/change.html', {'form': form})
@@ -494,8 +761,95 @@ class StarkHandler(object):
             return render(request, 'stark/delete.html', {'cancel': origin_list_url})
 
         self.model_class.objects.filter(pk=pk).delete()
+        self.clear_summary_cache()
         return redirect(origin_list_url)
 
+    def create_job(self, request, action_func_name, *args, **kwargs):
+        """
+        将后台action写入任务表，等待stark_worker执行
+        """
+        pk_list = request.POST.getlist('pk')
+        params = {'pk_list': pk_list, 'args': list(args), 'kwargs': kwargs}
+        return StarkJob.objects.create(
+            app_label=self.model_class._meta.app_label,
+            model_name=self.model_class._meta.model_name,
+            prev=self.prev,
+            action=action_func_name,
+            params=json.dumps(params),
+            total=len(pk_list),
+        )
+
+    def job_view(self, request, pk, *args, **kwargs):
+        """
+        后台任务进度页面，页面通过ajax轮询该URL获取任务状态
+        """
+        job = StarkJob.objects.filter(pk=pk, app_label=self.model_class._meta.app_label,
+                                      model_name=self.model_class._meta.model_name, prev=self.prev).first()
+        if not job:
+            return HttpResponse('任务不存在，请重新选择！')
+
+        if request.is_ajax():
+            return JsonResponse({
+                'status': job.status,
+                'status_text': job.get_status_display(),
+                'total': job.total,
+                'processed': job.processed,
+                'errors': job.errors,
+                'is_finished': job.is_finished,
+            })
+
+        # 返回列表页面时携带执行action前的搜索条件
+        list_url = reverse("%s:%s" % (self.site.namespace, self.get_list_url_name,), args=args, kwargs=kwargs)
+        origin_param = request.GET.get('_filter')
+        if origin_param:
+            list_url = "%s?%s" % (list_url, origin_param)
+        return render(request, 'stark/job.html', {'job': job, 'cancel': list_url})
+
+    def facet_view(self, request, field, *args, **kwargs):
+        """
+        组合搜索配置了limit时，分页加载其余选项，支持搜索。第1页即列表页面已显示的前N个，"更多"从第2页开始加载
+        ?_filter=列表页面的原搜索条件&page=2&keyword=xxx
+        """
+        option = None
+        field_object = None
+        for option_object in self.get_search_group():
+            if option_object.field != field or not option_object.limit:
+                continue
+            field_object = self.model_class._meta.get_field(field)
+            if isinstance(field_object, ForeignKey) or isinstance(field_object, ManyToManyField):  # choice不分页加载
+                option = option_object
+            break
+        if not option:
+            return HttpResponse('组合搜索字段不存在！')
+
+        queryset = option.get_related_queryset(field_object, request, *args, **kwargs)
+
+        try:
+            page = max(int(request.GET.get('page')), 1)
+        except (TypeError, ValueError):
+            page = 1
+        start = (page - 1) * option.limit
+        end = start + option.limit + 1  # 多取一条用于判断是否还有下一页
+
+        keyword = request.GET.get('keyword')
+        if keyword and option.search_field:  # 搜索结果按order_by或pk排序
+            queryset = queryset.filter(**{option.search_field: keyword}).order_by(*(option.order_by or ['pk']))
+            item_list = list(queryset[start:end])
+        else:
+            item_list = option.get_option_list(field_object, queryset, start, end)
+        has_more = len(item_list) > option.limit
+
+        # 选项的链接基于列表页面的搜索条件生成
+        query_dict = QueryDict(request.GET.get('_filter', ''))
+        # 已选中的选项一直显示在列表页面上，不再重复返回
+        selected_value_set = set(query_dict.getlist(field))
+        item_list = [item for item in item_list[:option.limit] if str(option.get_value(item)) not in selected_value_set]
+        row = SearchGroupRow(field_object.verbose_name, item_list, option, query_dict)
+        return JsonResponse({
+            'html': list(row.iter_options()),
+            'has_more': has_more,
+        })
+
     def get_url_name(self, param):
         """
         生成URL唯一name
@@ -534,6 +888,20 @@ class StarkHandler(object):
         """
         return self.get_url_name('delete')
 
+    @property
+    def get_facet_url_name(self):
+        """
+        获取组合搜索加载更多选项URL的name
+        """
+        return self.get_url_name('facet')
+
+    @property
+    def get_job_url_name(self):
+        """
+        获取后台任务进度页面URL的name
+        """
+        return self.get_url_name('job')
+
     def reverse_commons_url(self, name, *args, **kwargs):
         name = "%s:%s" % (self.site.namespace, name,)  # 生成name用于发现生成需要拼接namespace
         base_url = reverse(name, args=args, kwargs=kwargs)
@@ -574,6 +942,18 @@ class StarkHandler(object):
         """
         return self.reverse_commons_url(self.get_list_url_name, *args, **kwargs)
 
+    def reverse_facet_url(self, *args, **kwargs):
+        """
+        生成带有原搜索条件的组合搜索加载更多选项URL
+        """
+        return self.reverse_commons_url(self.get_facet_url_name, *args, **kwargs)
+
+    def reverse_job_url(self, *args, **kwargs):
+        """
+        生成带有原搜索条件的后台任务进度URL
+        """
+        return self.reverse_commons_url(self.get_job_url_name, *args, **kwargs)
+
     def wrapper(self, func):
         """
         相当于每一次请求进来，先执行inner函数，再执行原本的视图函数
@@ -586,15 +966,68 @@ class StarkHandler(object):
 
         return inner
 
+    def warmup(self, user=None):
+        """
+        预热该handler，让部署后第一个访问的用户不用承担冷启动的开销：
+        构造ModelForm类、反向解析URL、编译模板（包括继承的父模板）、缓存组合搜索的排序结果。
+        汇总结果按用户缓存，只有指定了user时才预热该用户默认条件下的汇总结果
+        :param user: 模拟访问列表页面的用户，默认为匿名用户
+        """
+        self.get_model_form_class()()  # 实例化一次，生成字段和widget
+
+        list_url = None
+        url_list = [
+            (self.get_list_url_name, {}),
+            (self.get_add_url_name, {}),
+            (self.get_change_url_name, {'pk': 0}),
+            (self.get_delete_url_name, {'pk': 0}),
+            (self.get_job_url_name, {'pk': 0}),
+        ]
+        for name, kwargs in url_list:
+            try:  # 自定制了get_urls或URL中带有其他参数时，部分URL可能无法直接反向解析
+                url_path = reverse("%s:%s" % (self.site.namespace, name,), kwargs=kwargs)
+            except NoReverseMatch:
+                continue
+            if name == self.get_list_url_name:
+                list_url = url_path
+
+        template_name_list = ['stark/changelist.html', 'stark/change.html', 'stark/delete.html', 'stark/job.html']
+        while template_name_list:
+            template = get_template(template_name_list.pop())
+            # extends的父模板在渲染时才加载，这里一并编译
+            for node in template.template.nodelist.get_nodes_by_type(ExtendsNode):
+                parent_name = node.parent_name.resolve(Context())
+                if isinstance(parent_name, str):
+                    template_name_list.append(parent_name)
+
+        if not list_url:
+            return
+        # 模拟访问列表页面不带任何条件的GET请求
+        request = HttpRequest()
+        request.method = 'GET'
+        request.path = request.path_info = list_url
+        request.user = user or AnonymousUser()
+        # handler是所有请求共用的对象，web进程运行中预热时不能修改其request，在拷贝的handler上执行
+        handler = copy.copy(self)
+        handler.request = request
+        for option in handler.get_search_group():
+            if option.limit and not option.order_by:  # 只有按关联数据条数排序的结果有缓存，其他选项预热后无法复用
+                option.get_queryset_or_tuple(handler.model_class, request)
+        if user and handler.get_list_summary():
+            queryset = handler.get_queryset(request).order_by(*handler.get_order_list())
+            handler.get_summary(request, queryset)
+
     def get_urls(self):
         """
-        获取默认每个model类4个URL
+        获取默认每个model类的URL（增删改查及后台任务进度）
         """
         patterns = [
             url(r'^list/$', self.wrapper(self.changelist_view), name=self.get_list_url_name),
             url(r'^add/$', self.wrapper(self.add_view), name=self.get_add_url_name),
             url(r'^change/(?P<pk>\d+)/$', self.wrapper(self.change_view), name=self.get_change_url_name),
             url(r'^delete/(?P<pk>\d+)/$', self.wrapper(self.delete_view), name=self.get_delete_url_name),
+            url(r'^job/(?P<pk>\d+)/$', self.wrapper(self.job_view), name=self.get_job_url_name),
+            url(r'^facet/(?P<field>\w+)/$', self.wrapper(self.facet_view), name=self.get_facet_url_name),
         ]
         # 如果不需要这么多URL，则可以自定制重写该函数get_urls，覆盖父类StarkHandler
 
@@ -643,6 +1076,60 @@ class StarkSite(object):
 
         return patterns
 
+    def get_handler(self, app_label, model_name, prev=None):
+        """
+        根据APP名、表名和前缀找到注册的handler对象，用于后台任务等不经过URL分发的场景
+        """
+        for item in self._registry:
+            model_class = item['model_class']
+            if model_class._meta.app_label != app_label or model_class._meta.model_name != model_name:
+                continue
+            if (item['prev'] or None) == (prev or None):
+                return item['handler']
+        return None
+
+    def warmup(self, max_workers=None, user=None):
+        """
+        并发预热所有注册的handler
+        :param max_workers: 线程数，默认使用ThreadPoolExecutor的默认值
+        :param user: 预热该用户的汇总结果，见StarkHandler.warmup
+        :return: [(handler, 耗时秒数, 异常或None), ...]
+        """
+        get_resolver().reverse_dict  # 先在当前线程中加载URL配置，避免多个线程同时加载
+
+        def run(handler):
+            start = time.time()
+            error = None
+            try:
+                handler.warmup(user=user)
+            except Exception as e:
+                error = e
+            finally:
+                connection.close()  # 每个线程有独立的数据库连接，用完关闭
+            return handler, time.time() - start, error
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(run, [item['handler'] for item in self._registry]))
+
+    def warmup_in_background(self, max_workers=None, user=None):
+        """
+        在后台线程中预热，不阻塞web进程启动。只应在web进程的入口调用，例如项目的wsgi.py：
+            application = get_wsgi_application()
+            site.warmup_in_background()
+        不放在AppConfig.ready()中，避免migrate等管理命令也执行预热
+        """
+
+        def run():
+            for handler, cost, error in self.warmup(max_workers=max_workers, user=user):
+                if error:
+                    logger.warning('stark预热失败 %s：%r', handler.get_list_url_name, error)
+                else:
+                    logger.info('stark预热 %s：%.3fs', handler.get_list_url_name, cost)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
     @property
     def urls(self):
         return self.get_urls(), self.app_name, self.namespace
@@ -1,3 +1,297 @@
-from django.test import TestCase
+import io
+import json
+import datetime
+from concurrent.futures.process import BrokenProcessPool
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from stark.models import StarkJob
+from stark.management.commands.stark_worker import Command as WorkerCommand, run_job
+from tests.models import Depart, UserInfo
+
+
+class StarkTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.depart = Depart.objects.create(title='IT')
+        self.user_list = [UserInfo.objects.create(name='user%s' % i, age=i, depart=self.depart) for i in range(3)]
+
+
+class BackgroundJobTest(StarkTestCase):
+    def create_job(self, **kwargs):
+        params = {'pk_list': [str(obj.pk) for obj in self.user_list]}
+        defaults = {'app_label': 'tests', 'model_name': 'userinfo', 'action': 'action_multi_grow',
+                    'params': json.dumps(params), 'total': len(self.user_list)}
+        defaults.update(kwargs)
+        return StarkJob.objects.create(**defaults)
+
+    def test_action_creates_job(self):
+        response = self.client.post('/stark/tests/userinfo/list/?q=', {
+            'action': 'action_multi_grow', 'pk': [self.user_list[0].pk]})
+        job = StarkJob.objects.get()
+        self.assertRedirects(response, '/stark/tests/userinfo/job/%s/?_filter=q%%3D' % job.pk,
+                             fetch_redirect_response=False)
+        self.assertEqual(job.status, 1)
+        self.assertEqual(job.total, 1)
+        self.assertIsNone(job.prev)
+        self.assertEqual(UserInfo.objects.get(pk=self.user_list[0].pk).age, 0)
+
+    def test_claim_and_run(self):
+        job = self.create_job()
+        self.assertEqual(WorkerCommand().claim_jobs(10), [job.pk])
+        self.assertEqual(WorkerCommand().claim_jobs(10), [])
+        run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 3)
+        self.assertEqual(job.processed, 3)
+        self.assertEqual(sorted(UserInfo.objects.values_list('age', flat=True)), [1, 2, 3])
+
+    def test_run_action_not_in_action_list(self):
+        job = self.create_job(action='action_not_exist', status=2)
+        run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 4)
+        self.assertIn('action_not_exist', job.errors)
+
+    def test_fail_stale_jobs(self):
+        long_ago = timezone.now() - datetime.timedelta(minutes=10)
+        stale_job = self.create_job(status=2, start_time=long_ago, heartbeat_time=long_ago)
+        running_job = self.create_job(status=2, start_time=long_ago)
+        command = WorkerCommand(stderr=io.StringIO())
+        command.heartbeat([running_job.pk])
+        command.fail_stale_jobs(60)
+
+        stale_job.refresh_from_db()
+        running_job.refresh_from_db()
+        self.assertEqual(stale_job.status, 4)
+        self.assertTrue(stale_job.is_finished)
+        self.assertEqual(running_job.status, 2)
+
+    def test_job_view_respects_prev(self):
+        job = self.create_job(prev='x')
+        response = self.client.get('/stark/tests/userinfo/job/%s/' % job.pk)
+        self.assertContains(response, '任务不存在')
+        response = self.client.get('/stark/tests/userinfo/x/job/%s/' % job.pk,
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.json()['status'], 1)
+
+
+class ListSummaryTest(StarkTestCase):
+    def test_summary_and_count_in_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/stark/tests/userinfo/list/')
+        self.assertEqual(response.context['pager'].all_count, 3)
+        self.assertIn('合计：3', response.context['summary_list'][1])
+        summary_sql_list = [query['sql'] for query in queries.captured_queries if 'tests_userinfo' in query['sql']
+                            and 'COUNT' in query['sql'] and 'tests_depart' not in query['sql']]
+        self.assertEqual(len(summary_sql_list), 1)
+        self.assertIn('SUM', summary_sql_list[0])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/stark/tests/userinfo/list/?page=2')
+        self.assertFalse([query for query in queries.captured_queries if 'SUM' in query['sql']])
+
+    def test_cache_invalidated_across_prev(self):
+        self.client.get('/stark/tests/userinfo/list/')
+        self.client.post('/stark/tests/userinfo/x/delete/%s/' % self.user_list[2].pk)
+        response = self.client.get('/stark/tests/userinfo/list/')
+        self.assertEqual(response.context['pager'].all_count, 2)
+        self.assertIn('合计：1', response.context['summary_list'][1])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_local_cache_not_used(self):
+        # LocMemCache只在当前进程有效，其他进程的数据变更无法让它失效，因此不缓存
+        for i in range(2):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get('/stark/tests/userinfo/list/')
+            self.assertTrue([query for query in queries.captured_queries if 'SUM' in query['sql']])
+
+    def test_cache_key_per_user(self):
+        from django.contrib.auth.models import User
+        from django.test import RequestFactory
+        from stark.service.v1 import site
+
+        handler = site.get_handler('tests', 'userinfo')
+        request_a = RequestFactory().get('/stark/tests/userinfo/list/')
+        request_a.user = User.objects.create(username='a')
+        request_b = RequestFactory().get('/stark/tests/userinfo/list/')
+        request_b.user = User.objects.create(username='b')
+        self.assertNotEqual(handler.get_summary_cache_key(request_a), handler.get_summary_cache_key(request_b))
+
+
+class SearchGroupFacetTest(StarkTestCase):
+    def setUp(self):
+        super(SearchGroupFacetTest, self).setUp()
+        # 按关联的用户数倒序：IT(3) sales(2) hr(1) ops(0) qa(0)
+        self.sales = Depart.objects.create(title='sales')
+        self.hr = Depart.objects.create(title='hr')
+        self.ops = Depart.objects.create(title='ops')
+        self.qa = Depart.objects.create(title='qa')
+        for i in range(2):
+            UserInfo.objects.create(name='sales%s' % i, depart=self.sales)
+        UserInfo.objects.create(name='hr0', depart=self.hr)
+
+    def get_row_html(self, response):
+        return ''.join(response.context['search_group_row_list'][0])
+
+    def get_facet(self, page, list_query=''):
+        response = self.client.get('/stark/tests/userinfo/facet/depart/', {'page': page, '_filter': list_query})
+        return response.json()
+
+    def test_top_n(self):
+        html = self.get_row_html(self.client.get('/stark/tests/userinfo/list/'))
+        self.assertIn('>IT<', html)
+        self.assertIn('>sales<', html)
+        self.assertNotIn('>hr<', html)
+        self.assertIn("data-page='2'", html)
+
+    def test_selected_out_of_top_n(self):
+        html = self.get_row_html(self.client.get('/stark/tests/userinfo/list/', {'depart': self.qa.pk}))
+        self.assertIn("<a class='active' href='?'>qa</a>", html)
+
+    def test_facet_pages(self):
+        data = self.get_facet(2)
+        self.assertEqual(len(data['html']), 2)
+        self.assertIn('>hr<', data['html'][0])
+        self.assertIn('>ops<', data['html'][1])
+        self.assertTrue(data['has_more'])
+        data = self.get_facet(3)
+        self.assertEqual(len(data['html']), 1)
+        self.assertFalse(data['has_more'])
+
+    def test_facet_skips_selected(self):
+        data = self.get_facet(2, 'depart=%s' % self.ops.pk)
+        self.assertEqual(len(data['html']), 1)
+        self.assertIn('>hr<', data['html'][0])
+        self.assertIn('depart=%s' % self.hr.pk, data['html'][0])
+
+    def test_facet_search(self):
+        response = self.client.get('/stark/tests/userinfo/facet/depart/', {'page': 1, 'keyword': 'q'})
+        self.assertEqual(len(response.json()['html']), 1)
+        self.assertIn('>qa<', response.json()['html'][0])
+
+    def test_facet_choice_field(self):
+        response = self.client.get('/stark/tests/userinfo/facet/gender/', {'page': 2})
+        self.assertContains(response, '组合搜索字段不存在')
+
+    def test_ordering_cached_and_invalidated(self):
+        self.client.get('/stark/tests/userinfo/list/')
+        with CaptureQueriesContext(connection) as queries:
+            self.get_facet(2)
+        self.assertFalse([query for query in queries.captured_queries if 'GROUP BY' in query['sql']])
+
+        # hr的用户数变为3，排到sales前面
+        for i in range(2):
+            UserInfo.objects.create(name='hr%s' % (i + 1), depart=self.hr)
+        self.client.post('/stark/tests/userinfo/x/delete/%s/' % self.user_list[0].pk)
+        html = self.get_row_html(self.client.get('/stark/tests/userinfo/list/'))
+        self.assertIn('>hr<', html)
+        self.assertNotIn('>sales<', html)
+
+
+class WarmupTest(TransactionTestCase):
+    """
+    预热在多个线程中执行，每个线程使用独立的数据库连接，需要真正提交测试数据
+    """
+
+    def setUp(self):
+        cache.clear()
+        depart = Depart.objects.create(title='IT')
+        UserInfo.objects.create(name='user', depart=depart)
+        UserInfo.objects.create(name='private', depart=depart)
+
+    def test_warmup_fills_caches(self):
+        from django.contrib.auth.models import User
+        from stark.service.v1 import site
+
+        user = User.objects.create(username='kris')
+        origin_request_list = [item['handler'].request for item in site._registry]
+        result = site.warmup(user=user)
+        self.assertEqual(len(result), 2)
+        for handler, cost, error in result:
+            self.assertIsNone(error)
+        # 不修改所有请求共用的handler
+        self.assertEqual([item['handler'].request for item in site._registry], origin_request_list)
+
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/stark/tests/userinfo/list/')
+        self.assertEqual(response.context['pager'].all_count, 2)
+        sql_list = [query['sql'] for query in queries.captured_queries]
+        self.assertFalse([sql for sql in sql_list if 'GROUP BY' in sql or 'SUM' in sql])
+
+
+class ProfileCommandTest(StarkTestCase):
+    def call_profile(self, *args):
+        import os
+        import tempfile
+        from django.core.management import call_command
+
+        stdout = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            call_command('stark_profile', 'tests/userinfo', *args, '-n', '3',
+                         '--collapsed', os.path.join(tmp_dir, 'out.collapsed'), stdout=stdout)
+        return stdout.getvalue()
+
+    def test_cold_runs_summary_every_time(self):
+        from stark.service.v1 import get_cache_version
+
+        self.client.get('/stark/tests/userinfo/list/')
+        version = get_cache_version(UserInfo)
+        output = self.call_profile()
+        # 冷模式不影响共享缓存：版本号不变，列表页面仍然命中缓存
+        self.assertEqual(get_cache_version(UserInfo), version)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/stark/tests/userinfo/list/')
+        self.assertFalse([query for query in queries.captured_queries if 'SUM' in query['sql']])
+
+        self.assertIn('缓存：冷', output)
+        summary_line_list = [line for line in output.splitlines() if 'SUM(' in line]
+        self.assertEqual(len(summary_line_list), 1)
+        self.assertIn('    3次', summary_line_list[0])
+
+    def test_warm_uses_cache(self):
+        output = self.call_profile('--warm')
+        self.assertIn('缓存：热', output)
+        summary_line_list = [line for line in output.splitlines() if 'SUM(' in line]
+        self.assertIn('    1次', summary_line_list[0])
+
+
+class BrokenPool(object):
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool('子进程被kill')
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class BrokenPoolWorkerTest(StarkTestCase):
+    def test_broken_pool_fails_claimed_jobs_and_recreates(self):
+        job_list = [StarkJob.objects.create(app_label='tests', model_name='userinfo', action='action_multi_grow')
+                    for i in range(2)]
+        pool_list = []
+
+        class Command(WorkerCommand):
+            def create_pool(self, max_workers):
+                pool_list.append(BrokenPool())
+                return pool_list[-1]
+
+        Command(stdout=io.StringIO(), stderr=io.StringIO()).handle(processes=2, interval=0, once=True, stale=60)
+        self.assertEqual(len(pool_list), 2)
+        for job in job_list:
+            job.refresh_from_db()
+            self.assertEqual(job.status, 4)
+            self.assertIn('BrokenProcessPool', job.errors)
+
+    def test_run_job_keeps_stale_failure(self):
+        job = StarkJob.objects.create(app_label='tests', model_name='userinfo', action='action_multi_grow',
+                                      params=json.dumps({'pk_list': []}), status=2)
+        StarkJob.objects.filter(pk=job.pk).update(status=4, errors='执行该任务的worker已退出\n')
+        run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 4)
+        self.assertIn('worker已退出', job.errors)